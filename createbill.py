@@ -8,15 +8,15 @@ Bill calculation
 import argparse
 from dataclasses import dataclass
 import logging
-from typing import Dict
+from typing import Dict, List
+import os
 import sys
-import shutil
-import tempfile
+import zipfile
 
 from nebenkosten import Date, DateRange, DateCoverage, Invoice, BillCalculationItem, SplitType
 from nebenkosten import RowWriter, ResultSheet, ResultSheetWriter, InputSheetReader
 from nebenkosten import MeterManager
-from nebenkosten import InvalidCellValue, InputFileError
+from nebenkosten import InputFileError
 from nebenkosten import get_people_count_changes
 
 __author__ = "Paul Wichern"
@@ -26,6 +26,22 @@ __version__ = "1.0.0"
 WATER_TEMPERATURE_COLD = 10
 WATER_TEMPERATURE_WARM = 43
 
+# Wärmeverbrauch für Warmwasser (kWh) = Warmwasserverbrauch (m³) x
+#   (Warmwassertemperatur (K) – Kaltwassertemperatur (K)) x 2,5
+CONVERSION_FACTOR_M3_TO_KWH = (WATER_TEMPERATURE_WARM - WATER_TEMPERATURE_COLD) * 2.5
+
+# Formulas of a bill item row in the DETAILS sheet.
+FORMULA_DAYS = '=_xlfn.days(B{row}, A{row})+1'
+FORMULA_GROSS = '=G{row}*H{row}*(1+I{row})'
+FORMULA_INVOICE_DAYS = '=_xlfn.days("{end}", "{begin}")+1'
+FORMULA_SUM_CONSUMPTION = '=G{row}*(1+I{row})*M{row}'
+FORMULA_SUM_PERCENTAGE = '=J{row}/K{row}*C{row}*M{row}'
+
+# Formula of a calculated meter value in the METER_VALUES sheet: The value measured before plus
+# the consumption between the surrounding measured values, scaled by the share of days.
+FORMULA_METER_VALUE = '=C{before}+(C{after}-C{before})'\
+    '/_xlfn.days(B{after},B{before})*_xlfn.days(B{row},B{before})'
+
 # 2.0
 # TODO: Sort BCI by which is limiting bill creation the most.
 #       e.g.:   Strom bis 31.12.2020, Wasser bis 31.03.2021, Müll bis 15.04.2021, ...
@@ -43,11 +59,12 @@ WATER_TEMPERATURE_WARM = 43
 @dataclass
 class BillItem:
     ''' Temporary storage for bill item (DETAILS sheet). '''
+    __slots__ = ('invoice', 'bci', 'billed_range', 'split_percentage', 'comment')
     invoice: Invoice
     bci: BillCalculationItem
     billed_range: DateRange
     split_percentage: str
-    comment: str = None
+    comment: str
 
     def write(self, row_writer: RowWriter):
         ''' Write this bill item into the result sheet. '''
@@ -56,7 +73,7 @@ class BillItem:
 
         row_writer.write_date(self.billed_range.begin)
         row_writer.write_date(self.billed_range.end)
-        row_writer.write_number(f'=_xlfn.days(B{row}, A{row})+1', precision=0)
+        row_writer.write_number(FORMULA_DAYS.format(row=row), precision=0)
         row_writer.write(self.invoice.type)
         if self.comment:
             row_writer.write(self.comment)
@@ -66,18 +83,18 @@ class BillItem:
         row_writer.write_currency(self.invoice.net)
         row_writer.write_number(self.invoice.amount)
         row_writer.write_percentage(self.invoice.tax)
-        row_writer.write_currency(f'=G{row}*H{row}*(1+I{row})')
+        row_writer.write_currency(FORMULA_GROSS.format(row=row))
         row_writer.write_number(
-            f'=_xlfn.days("{self.invoice.range.end}", "{self.invoice.range.begin}")+1',
+            FORMULA_INVOICE_DAYS.format(end=self.invoice.range.end, begin=self.invoice.range.begin),
             unit='Tage',
             precision=0)
-        row_writer.write(self.bci.split)
-        if self.bci.split == SplitType.PER_CONSUMPTION.value:
+        row_writer.write(self.bci.split.value)
+        if self.bci.split is SplitType.PER_CONSUMPTION:
             row_writer.write_number(self.split_percentage, unit=self.bci.unit)
-            row_writer.write_currency(f'=G{row}*(1+I{row})*M{row}')
+            row_writer.write_currency(FORMULA_SUM_CONSUMPTION.format(row=row))
         else:
             row_writer.write_percentage(self.split_percentage)
-            row_writer.write_currency(f'=J{row}/K{row}*C{row}*M{row}')
+            row_writer.write_currency(FORMULA_SUM_PERCENTAGE.format(row=row))
         row_writer.write(self.invoice.path)
 
 # pylint: disable=too-few-public-methods
@@ -89,28 +106,50 @@ class BillCreator:
         self._range = bill_range
         self._out = ResultSheetWriter()
         self._out_path = out_path
-        self._bill_items = []
         self._split_dates = get_people_count_changes(bill_range, input_sheet.tenants)
         self._coverages = {bci.invoice_type: DateCoverage(bill_range) for bci in input_sheet.bcis}
+
+        # Bucket the invoices overlapping the bill range by their type, so that every BCI only
+        # needs a lookup instead of a scan over all invoices.
+        self._invoices_by_type: Dict[str, List[Invoice]] = {}
+        for invoice in input_sheet.invoices:
+            if invoice.range.overlaps(bill_range):
+                self._invoices_by_type.setdefault(invoice.type, []).append(invoice)
         self._receipts = set()
 
+        # Several BCIs may bill the same meter, e.g. water for two invoice types.
+        self._meter_managers: Dict[str, MeterManager] = {}
+
+        # BCIs are handled by their split type. Everything else is split by percentage.
+        self._handlers = {
+            SplitType.PER_CONSUMPTION: self.__per_consumption,
+            SplitType.PER_PERSON: self.__per_person,
+        }
+
+        # The share of percentage based splits does not depend on the invoice.
+        total_size = sum(a.size for a in input_sheet.appartements)
+        self._split_percentages = {
+            SplitType.PER_APPARTEMENT: f'=1/{len(input_sheet.appartements)}',
+            SplitType.PER_SQUAREMETER: f'={input_sheet.appartement.size}/{total_size}',
+            SplitType.HALF: '=1/2',
+            SplitType.THIRD: '=1/3',
+            SplitType.QUARTER: '=1/4',
+            SplitType.COMPLETE: '1',
+        }
+
     def create(self, receipts_dir : str):
         ''' Create the bill '''
 
         for bci in self._input.bcis:
             logging.debug(bci)
-            if bci.split == SplitType.PER_CONSUMPTION.value:
-                self.__per_consumption(bci)
-            elif bci.split == SplitType.PER_PERSON.value:
-                self.__per_person(bci)
-            else:
-                self.__per_percentage(bci)
+            self._handlers.get(bci.split, self.__per_percentage)(bci)
 
-        # Analyze bill coverage
-        for bci in self._input.bcis:
-            for uncovered_range in self._coverages[bci.invoice_type].ranges:
-                logging.warning('Für "%s" wurde von %s bis %s nichts in Rechnung gestellt.',
-                    bci.invoice_type, uncovered_range.begin, uncovered_range.end)
+        # Analyze bill coverage (only reported as warnings)
+        if logging.getLogger().isEnabledFor(logging.WARNING):
+            for bci in self._input.bcis:
+                for uncovered_range in self._coverages[bci.invoice_type].ranges:
+                    logging.warning('Für "%s" wurde von %s bis %s nichts in Rechnung gestellt.',
+                        bci.invoice_type, uncovered_range.begin, uncovered_range.end)
 
         # We write the overview after calculating the bill.
         # This way we already know how many rows where added to the DETAILS sheet.
@@ -123,11 +162,17 @@ class BillCreator:
 
         # Create zip file with receipts
         logging.info('Erstelle Archiv mit Rechnungen ...')
-        with tempfile.TemporaryDirectory() as temp_dir:
-            for receipt in self._receipts:
-                if receipt:
-                    shutil.copy(receipts_dir + '/' + receipt, temp_dir + '/' + receipt)
-            shutil.make_archive(self._out_path.replace('.xlsx', ''), 'zip', temp_dir)
+        receipts = sorted(r for r in self._receipts if r)
+        # Check all receipts first, so that a missing one does not leave a partial archive behind.
+        for receipt in receipts:
+            receipt_path = os.path.join(receipts_dir, receipt)
+            if not os.path.isfile(receipt_path):
+                logging.error('Rechnung "%s" nicht gefunden.', receipt_path)
+                raise FileNotFoundError(receipt_path)
+        archive_path = self._out_path.replace('.xlsx', '') + '.zip'
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for receipt in receipts:
+                archive.write(os.path.join(receipts_dir, receipt), arcname=receipt)
 
     # pylint: disable=too-many-locals
     def __per_consumption(self, bci):
@@ -141,63 +186,54 @@ class BillCreator:
         # 1. Create all meter values that do not exist already and store all meter values we
         #    want to see in our result sheet into a set.
         dates = set()
-        meter_manager = MeterManager(self._input.meter_values, bci.meter)
-        for invoice in self.__invoices(bci):
+        meter_manager = self.__meter_manager(bci.meter)
+        measured = meter_manager.values
+        # Clip every invoice to the bill range once, steps 1 and 4 both need it.
+        bill_begin, bill_end = self._range.begin, self._range.end
+        invoices = [
+            (invoice, DateRange(
+                max(invoice.range.begin, bill_begin),
+                min(invoice.range.end, bill_end)))
+            for invoice in self.__invoices(bci)]
+        for invoice, consumption_range in invoices:
             logging.debug(invoice)
-
-            consumption_range = DateRange(
-                max(invoice.range.begin, self._range.begin),
-                min(invoice.range.end, self._range.end))
-
             logging.debug('Verbrauchszeitraum: %s bis %s',
                 consumption_range.begin, consumption_range.end)
 
-            dates.add(consumption_range.begin)
-            dates.add(consumption_range.end)
-
-            if consumption_range.begin not in meter_manager.values:
-                date_before, date_after = meter_manager.get_surrounding_dates(
-                    consumption_range.begin)
-                dates.add(date_before)
-                dates.add(date_after)
-
-            if consumption_range.end not in meter_manager.values:
-                date_before, date_after = meter_manager.get_surrounding_dates(
-                    consumption_range.end)
-                dates.add(date_before)
-                dates.add(date_after)
-
-        # 2. Save all meter values to result sheet.
-        rows: Dict[Date, int] = {}
-        for mv_date in sorted(dates):
-            row = self._out.row_writer(ResultSheet.METER_VALUES)
+            for date in (consumption_range.begin, consumption_range.end):
+                dates.add(date)
+
+                # Not measured dates are calculated from their surrounding meter values.
+                if date not in measured:
+                    dates.update(meter_manager.get_surrounding_dates(date))
+
+        # 2. Reserve a row for every meter value, so that calculated meter values can refer to
+        #    the rows of their surrounding measured values right away.
+        row_writer = self._out.row_writer
+        writers = [(mv_date, row_writer(ResultSheet.METER_VALUES)) for mv_date in sorted(dates)]
+        rows: Dict[Date, int] = {mv_date: row.row() for mv_date, row in writers}
+
+        # 3. Save all meter values to result sheet.
+        for mv_date, row in writers:
             row.write(bci.meter)
             row.write_date(mv_date)
 
-            if mv_date in meter_manager.values:
-                row.write_number(meter_manager.values[mv_date].count, unit=meter.unit)
+            meter_value = measured.get(mv_date)
+            if meter_value is not None:
+                row.write_number(meter_value.count, unit=meter.unit)
                 row.write('Gemessen')
-
-            rows[mv_date] = row.row()
-
-        # 3. Update all meter value formulas, now that we know their rows in the result sheet.
-        for mv_date in sorted(dates):
-            if mv_date not in meter_manager.values:
-                row = rows[mv_date]
+            else:
                 count = self.__count_formula(mv_date, meter_manager, rows)
-                self._out.cell_writer(ResultSheet.METER_VALUES, row, 3)\
-                    .write_number(count, unit=meter.unit)
-                self._out.cell_writer(ResultSheet.METER_VALUES, row, 4)\
-                    .write('Berechnet')
+                row.write_number(count, unit=meter.unit)
+                row.write('Berechnet')
 
         # 4. Save all bill items to the result sheet.
-        for invoice in self.__invoices(bci):
-            consumption_range = DateRange(
-                max(invoice.range.begin, self._range.begin),
-                min(invoice.range.end, self._range.end))
-
-            consumption = f'{ResultSheet.METER_VALUES.value}!C{rows[consumption_range.end]}'\
-                f'-{ResultSheet.METER_VALUES.value}!C{rows[consumption_range.begin]}'
+        meter_sheet = ResultSheet.METER_VALUES.value
+        coverage = self._coverages[bci.invoice_type]
+        receipts = []
+        for invoice, consumption_range in invoices:
+            consumption = f'{meter_sheet}!C{rows[consumption_range.end]}'\
+                f'-{meter_sheet}!C{rows[consumption_range.begin]}'
 
             # Check if unit types match and add conversion and comment otherwise.
             comment = None
@@ -207,67 +243,66 @@ class BillCreator:
 
             bill_item = BillItem(
                 invoice, bci, consumption_range, f'={consumption}', comment=comment)
-            bill_item.write(self._out.row_writer(ResultSheet.DETAILS))
-            self._receipts.add(invoice.path)
+            bill_item.write(row_writer(ResultSheet.DETAILS))
+            receipts.append(invoice.path)
 
             # Update bill coverage for this BCI
-            self._coverages[bci.invoice_type].cover(bill_item.billed_range)
+            coverage.cover(bill_item.billed_range)
+
+        self._receipts.update(receipts)
 
     def __per_person(self, bci):
         ''' Handle all BCI that are based on tenant count '''
 
+        bill_begin, bill_end = self._range.begin, self._range.end
+        row_writer = self._out.row_writer
+        coverage = self._coverages[bci.invoice_type]
+        receipts = []
         for invoice in self.__invoices(bci):
             logging.debug(invoice)
+            receipts.append(invoice.path)
 
             comment = None  # In order to only append the comment to the second invoice
             for invoice_part, people_count in invoice.split(self._split_dates):
                 logging.debug('Rechnungsteil (%d Personen): %s', people_count, str(invoice_part))
                 billed_range = DateRange(
-                    max(invoice_part.range.begin, self._range.begin),
-                    min(invoice_part.range.end, self._range.end))
+                    max(invoice_part.range.begin, bill_begin),
+                    min(invoice_part.range.end, bill_end))
                 split_percentage = f'={self._input.tenant.people}/{people_count}'
                 bill_item = BillItem(invoice, bci, billed_range, split_percentage, comment=comment)
-                bill_item.write(self._out.row_writer(ResultSheet.DETAILS))
-                self._receipts.add(invoice.path)
+                bill_item.write(row_writer(ResultSheet.DETAILS))
 
                 # Update bill coverage for this BCI
-                self._coverages[bci.invoice_type].cover(bill_item.billed_range)
+                coverage.cover(bill_item.billed_range)
 
                 # Comment will be added to the second invoice, if it was split.
                 comment = 'Gesamtbewohnerzahl geändert'
 
+        self._receipts.update(receipts)
+
     def __per_percentage(self, bci):
         ''' Handle all BCI that are based on percentage '''
 
+        split_percentage = self._split_percentages[bci.split]
+
+        bill_begin, bill_end = self._range.begin, self._range.end
+        row_writer = self._out.row_writer
+        coverage = self._coverages[bci.invoice_type]
+        receipts = []
         for invoice in self.__invoices(bci):
             logging.debug(invoice)
 
-            split_percentage = ''
-            if bci.split == SplitType.PER_APPARTEMENT.value:
-                split_percentage = f'=1/{len(self._input.appartements)}'
-            elif bci.split == SplitType.PER_SQUAREMETER.value:
-                split_percentage = f'={self._input.appartement.size}'\
-                    f'/{sum(a.size for a in self._input.appartements)}'
-            elif bci.split == SplitType.HALF.value:
-                split_percentage = '=1/2'
-            elif bci.split == SplitType.THIRD.value:
-                split_percentage = '=1/3'
-            elif bci.split == SplitType.QUARTER.value:
-                split_percentage = '=1/4'
-            elif bci.split == SplitType.COMPLETE.value:
-                split_percentage = '1'
-            else:
-                raise InvalidCellValue(f'Unknown bill split: "{bci.split}"')
-
             billed_range = DateRange(
-                max(invoice.range.begin, self._range.begin),
-                min(invoice.range.end, self._range.end))
-            bill_item = BillItem(invoice, bci, billed_range, split_percentage)
-            bill_item.write(self._out.row_writer(ResultSheet.DETAILS))
-            self._receipts.add(invoice.path)
+                max(invoice.range.begin, bill_begin),
+                min(invoice.range.end, bill_end))
+            bill_item = BillItem(invoice, bci, billed_range, split_percentage, comment=None)
+            bill_item.write(row_writer(ResultSheet.DETAILS))
+            receipts.append(invoice.path)
 
             # Update bill coverage for this BCI
-            self._coverages[bci.invoice_type].cover(bill_item.billed_range)
+            coverage.cover(bill_item.billed_range)
+
+        self._receipts.update(receipts)
 
     def __count_formula(self,
                         date: Date,
@@ -276,31 +311,25 @@ class BillCreator:
         ''' Create a formula, that calculates the meter value. '''
 
         before, after = meter_manager.get_surrounding_dates(date)
-        before_row = rows[before]
-        after_row = rows[after]
-
-        # Calculate the total consumption between measured values.
-        delta_value = f'C{after_row}-C{before_row}'
-
-        # Calculate the days between measured values.
-        delta_days_total = f'_xlfn.days(B{after_row},B{before_row})'
-
-        # Calculate the days between before date and date.
-        delta_days_new = f'_xlfn.days(B{rows[date]},B{before_row})'
+        return FORMULA_METER_VALUE.format(before=rows[before], after=rows[after], row=rows[date])
 
-        return f'=C{before_row}+({delta_value})/{delta_days_total}*{delta_days_new}'
+    def __meter_manager(self, meter_name: str) -> MeterManager:
+        ''' Get the meter manager of given meter, created on first use. '''
+        meter_manager = self._meter_managers.get(meter_name)
+        if not meter_manager:
+            meter_manager = MeterManager(
+                self._input.meter_values_by_name.get(meter_name, []), meter_name)
+            self._meter_managers[meter_name] = meter_manager
+        return meter_manager
 
     def __invoices(self, bci):
         ''' Get all invoices related to this BCI. '''
-        return filter(lambda i: i.type == bci.invoice_type \
-            and i.range.overlaps(self._range), self._input.invoices)
+        return self._invoices_by_type.get(bci.invoice_type, [])
 
     def __convert_units(self, unit_from: str, unit_to: str, value: str) -> str:
         ''' Add Excel formula to convert `value` '''
         if unit_from == 'm³' and unit_to == 'kWh':
-            # Wärmeverbrauch für Warmwasser (kWh) = Warmwasserverbrauch (m³) x
-            #   (Warmwassertemperatur (K) – Kaltwassertemperatur (K)) x 2,5
-            return f'({value})*({WATER_TEMPERATURE_WARM}-{WATER_TEMPERATURE_COLD})*2.5'
+            return f'({value})*{CONVERSION_FACTOR_M3_TO_KWH}'
         logging.error('Kann "%s" nicht in "%s" konvertieren.', unit_from, unit_to)
         raise InputFileError
 
@@ -308,11 +337,11 @@ def main():
     ''' Main '''
     # Parse command line arguments.
     parser = argparse.ArgumentParser(description='Nebenkosten Abrechner')
-    parser.add_argument('invoices', help='Pfad zu Nebenkostentabelle', nargs='?')
-    parser.add_argument('begin', help='Startdatum', nargs='?', type=Date.from_str)
-    parser.add_argument('end', help='Enddatum', nargs='?', type=Date.from_str)
-    parser.add_argument('appartement', help='Wohnung', nargs='?')
-    parser.add_argument('receipts', help='Ordner mit gescannten Rechnungen', nargs='?')
+    parser.add_argument('invoices', help='Pfad zu Nebenkostentabelle')
+    parser.add_argument('begin', help='Startdatum', type=Date.from_str)
+    parser.add_argument('end', help='Enddatum', type=Date.from_str)
+    parser.add_argument('appartement', help='Wohnung')
+    parser.add_argument('receipts', help='Ordner mit gescannten Rechnungen')
     args = parser.parse_args()
 
     filename = f'{args.appartement}-{args.begin}-{args.end}'\
@@ -3,7 +3,7 @@
 
 ''' Package for nebenkosten helper '''
 
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 # Move everything into this namespace
 from nebenkosten.types import *
@@ -13,20 +13,34 @@ from nebenkosten.meter import *
 def get_people_count_changes(range, tenants) -> List[Tuple[Date, int]]:
     ''' Calculate a list of dates and their new people count '''
 
-    ret = []
+    # Every tenant adds its people on the day of moving in and removes them on the day after
+    # moving out. Sweeping over these events in order yields the people count after each change.
+    # Days are handled as ordinals, so comparisons and day arithmetic are plain integer operations.
+    begin: int = range.begin.to_ordinal()
+    end: int = range.end.to_ordinal()
+    events: Dict[int, int] = {begin: 0}
+    for tenant in tenants:
+        moving_in: int = tenant.moving_in.to_ordinal()
+        moving_out: Optional[int] = tenant.moving_out.to_ordinal() if tenant.moving_out else None
+
+        if moving_in > end:
+            continue
+        if moving_out is not None and moving_out < begin:
+            continue
 
-    date = range.begin
-    idx: int = 0
-    people_count_before: int = -1
+        moving_in = max(moving_in, begin)
+        events[moving_in] = events.get(moving_in, 0) + tenant.people
 
-    while date <= range.end:
-        people_count: int = sum(t.people for t in tenants if date in t)
+        if moving_out is not None and moving_out < end:
+            events[moving_out + 1] = events.get(moving_out + 1, 0) - tenant.people
+
+    ret = []
+    people_count: int = 0
 
-        if people_count != people_count_before:
-            ret.append((date, people_count))
+    for day in sorted(events):
+        people_count += events[day]
 
-        people_count_before = people_count
-        date = date.tomorrow()
-        idx += 1
+        if not ret or people_count != ret[-1][1]:
+            ret.append((Date.from_ordinal(day), people_count))
 
     return ret
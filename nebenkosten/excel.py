@@ -6,15 +6,17 @@ Reader for input and output excel sheets.
 '''
 
 import enum
+import functools
+import io
 import logging
 import os
-from typing import List
+from typing import Dict, List, Optional
 
 import openpyxl
 
 from nebenkosten.types import Invoice, Appartement, Tenant, MeterValue, Meter
 from nebenkosten.types import Date, DateRange, BillCalculationItem
-from nebenkosten import InputFileError, SplitType
+from nebenkosten import InputFileError, InvalidCellValue, SplitType
 
 class InputSheet(enum.Enum):
     ''' Name of the sheets in the input file '''
@@ -25,7 +27,7 @@ class InputSheet(enum.Enum):
     METERS = 'Zähler'
     BILL_CALCULATION_ITEMS = 'Abrechnungseinstellungen'
 
-# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
 class InputSheetReader:
     '''
     Parse the input sheet.
@@ -39,7 +41,10 @@ class InputSheetReader:
         '''
 
         logging.debug('Lade %s ...', path)
-        workbook = openpyxl.load_workbook(filename=str(path))
+        # The read-only mode is not used: it trusts the dimension stored in the file, which may be
+        # stale, and would then silently drop rows. Links to external workbooks are not needed
+        # for reading values and are not loaded.
+        workbook = openpyxl.load_workbook(filename=str(path), keep_links=False)
 
         self.invoices = []
         for row in self.__get_rows(workbook, InputSheet.INVOICES):
@@ -95,8 +100,9 @@ class InputSheetReader:
                 raise ValueError(f'Lesen von {row} fehlgeschlagen: {str(value_error)}') 
         logging.debug('%d Mieter', len(self.tenants))
 
-        self.tenant = next((t for t in self.tenants if bill_range.begin in t\
-            and t.appartement == appartement_name), None)
+        # Compare the appartement first, it is cheaper than the date check.
+        self.tenant = next((t for t in self.tenants if t.appartement == appartement_name\
+            and bill_range.begin in t), None)
         if not self.tenant:
             logging.error('Kein Mieter für den Zeitraum in der Wohnung bekannt.')
             raise InputFileError()
@@ -107,25 +113,37 @@ class InputSheetReader:
         logging.info('Mieter: %s', self.tenant.name)
 
         self.meter_values = []
+        # Meter values are only ever looked up by meter, so group them once.
+        self.meter_values_by_name: Dict[str, List[MeterValue]] = {}
         for row in self.__get_rows(workbook, InputSheet.METER_VALUES):
             try:
-                self.meter_values.append(MeterValue(row[0], row[1], Date.from_str(row[2]), row[3]))
+                meter_value = MeterValue(row[0], row[1], Date.from_str(row[2]), row[3])
             except ValueError as value_error:
                 raise ValueError(f'Lesen von {row} fehlgeschlagen: {str(value_error)}') 
+            self.meter_values.append(meter_value)
+            self.meter_values_by_name.setdefault(meter_value.name, []).append(meter_value)
         logging.debug('%d Zählerstände', len(self.meter_values))
 
         self.meter = []
+        self._meter_by_name: Dict[str, Meter] = {}
         for row in self.__get_rows(workbook, InputSheet.METERS):
-            self.meter.append(Meter(row[0], row[1], row[2]))
+            meter = Meter(row[0], row[1], row[2])
+            self.meter.append(meter)
+            # The first meter of a name wins, as with a linear search.
+            self._meter_by_name.setdefault(meter.name, meter)
         logging.debug('%d Zähler', len(self.meter))
 
         self.bcis = []
         for row in self.__get_rows(workbook, InputSheet.BILL_CALCULATION_ITEMS):
-            bci = BillCalculationItem(row[0], row[1], row[2], row[3], row[4], row[5])
             # Skip BCIs that are not relevant for this appartement
-            if bci.appartement == appartement_name:
+            if row[0] == appartement_name:
+                try:
+                    split = SplitType(row[1])
+                except ValueError as value_error:
+                    raise InvalidCellValue(f'Unknown bill split: "{row[1]}"') from value_error
+                bci = BillCalculationItem(row[0], split, row[2], row[3], row[4], row[5])
                 # Check that for consumption there is a unit specified
-                if bci.split == SplitType.PER_CONSUMPTION.value and not bci.unit:
+                if bci.split is SplitType.PER_CONSUMPTION and not bci.unit:
                     logging.critical('Abrechnung für "%s", "%s" nach Verbrauch, aber ohne Einheit zu definieren',
                         bci.appartement, bci.invoice_type)
                     raise InputFileError
@@ -135,17 +153,45 @@ class InputSheetReader:
     def __get_rows(self, workbook, sheet: InputSheet):
         ''' Get all data rows of given sheet. '''
         sheet = workbook[sheet.value]
+        # No explicit bounds: in normal mode, iter_rows takes them from the cells, not from the
+        # dimension stored in the file, and pads every row to the width of the sheet.
         # We need to filter out the rows without content, because we will receive those as well.
-        return filter(lambda row: row[0], sheet.iter_rows(min_row=2, values_only=True))
+        return (row for row in sheet.iter_rows(min_row=2, values_only=True) if row[0])
 
     def get_meter(self, meter_name) -> Meter:
         ''' Get Meter by name. '''
-        return next((m for m in self.meter if m.name == meter_name), None)
-
-    def get_invoices(self, bci: BillCalculationItem, date_range: DateRange) -> List[Invoice]:
-        ''' List all invoices related to given bci in given date range. '''
-        return filter(lambda i: i.type == bci.invoice_type and i.range.overlaps(date_range),
-            self.invoices)
+        return self._meter_by_name.get(meter_name)
+
+# Fonts of the named styles used in the result sheet. They are shared by all result workbooks.
+STYLE_FONTS = {
+    'header': openpyxl.styles.Font(name='Calibri', bold=True, size=11),
+    'header-overview': openpyxl.styles.Font(name='Calibri', bold=True, size=14),
+    'double-underlined': openpyxl.styles.Font(
+        name='Calibri', size=11, bold=True, underline='double'),
+    'content': openpyxl.styles.Font(name='Calibri', size=11),
+    'bold': openpyxl.styles.Font(name='Calibri', size=11, bold=True),
+}
+
+# Number formats of the result sheet.
+NUMBER_FORMAT_DATE = 'DD.MM.YY'
+NUMBER_FORMAT_CURRENCY = '0.00" "€'
+NUMBER_FORMAT_PERCENTAGE = '0.00" "%'
+
+@functools.lru_cache(maxsize=None)
+def _number_format(precision: int, unit: Optional[str]) -> str:
+    ''' Get number format with given precision and unit. There are only a few combinations. '''
+    number_format = '0'
+    if precision > 0:
+        number_format += '.' + (precision * '0')
+    if unit:
+        number_format += f'" {unit}"'
+    return number_format
+
+@functools.lru_cache(maxsize=1)
+def _read_template(filepath: str) -> bytes:
+    ''' Read the result sheet template only once, even when creating several bills. '''
+    with open(filepath, 'rb') as template:
+        return template.read()
 
 class ResultSheet(enum.Enum):
     ''' Sheet names in the result sheet. '''
@@ -153,6 +199,13 @@ class ResultSheet(enum.Enum):
     DETAILS = 'Details'
     METER_VALUES = 'Zählerstände'
 
+# Formulas of the overview sheet.
+FORMULA_MONTHLY = '=D{row}/((_xlfn.days($D$2,$C$2)+2)'\
+    '/IF(OR(MOD($C$2,400)=0,AND(MOD($C$2,4)=0,MOD($C$2,100)<>0)),365,366)*12)'
+FORMULA_SUMIF = f'SUMIF({ResultSheet.DETAILS.value}!$D$2:$D${{end}},"{{invoice_type}}",'\
+    f'{ResultSheet.DETAILS.value}!$N$2:$N${{end}})'
+FORMULA_SUM = '=SUM(${column}$5:${column}${end})'
+
 class CellWriter:
     ''' Helper class to write into a cell of a sheet '''
 
@@ -163,26 +216,19 @@ class CellWriter:
 
     def write_date(self, date: Date, style: str = 'content'):
         ''' Write a date '''
-        self.write(date.date, style=style, number_format='DD.MM.YY')
+        self.write(date.date, style=style, number_format=NUMBER_FORMAT_DATE)
 
     def write_number(self, number: str, style: str = 'content', unit: str = None, precision: int = 2):
         ''' Write a nunmber '''
-        precision_format = '0'
-        if precision > 0:
-            precision_format += '.' + (precision * '0')
-
-        if unit:
-            self.write(number, style=style, number_format=f'{precision_format}" {unit}"')
-        else:
-            self.write(number, style=style, number_format=precision_format)
+        self.write(number, style=style, number_format=_number_format(precision, unit))
 
     def write_currency(self, number: str, style: str = 'content'):
         ''' Write a currency '''
-        self.write(number, style=style, number_format='0.00" "€')
+        self.write(number, style=style, number_format=NUMBER_FORMAT_CURRENCY)
 
     def write_percentage(self, number: str, style: str = 'content'):
         ''' Write a percentage '''
-        self.write(number, style=style, number_format='0.00" "%')
+        self.write(number, style=style, number_format=NUMBER_FORMAT_PERCENTAGE)
 
     def write(self, content, style: str = 'content', number_format = None):
         ''' Write into a cell '''
@@ -219,30 +265,16 @@ class ResultSheetWriter:
         }
 
         logging.info('Lese Vorlage von ' + self.template_filepath)
-        self._wb = openpyxl.load_workbook(self.template_filepath)
+        self._wb = openpyxl.load_workbook(io.BytesIO(_read_template(self.template_filepath)))
         self.__define_styles()
 
     def __define_styles(self):
         ''' Create named styles for use in CellWrite, RowWriter '''
-        style = openpyxl.styles.NamedStyle(name='header')
-        style.font = openpyxl.styles.Font(name='Calibri', bold=True, size=11)
-        self._wb.add_named_style(style)
-
-        style = openpyxl.styles.NamedStyle(name='header-overview')
-        style.font = openpyxl.styles.Font(name='Calibri', bold=True, size=14)
-        self._wb.add_named_style(style)
-
-        style = openpyxl.styles.NamedStyle(name='double-underlined')
-        style.font = openpyxl.styles.Font(name='Calibri', size=11, bold=True, underline='double')
-        self._wb.add_named_style(style)
-
-        style = openpyxl.styles.NamedStyle(name='content')
-        style.font = openpyxl.styles.Font(name='Calibri', size=11)
-        self._wb.add_named_style(style)
-
-        style = openpyxl.styles.NamedStyle(name='bold')
-        style.font = openpyxl.styles.Font(name='Calibri', size=11, bold=True)
-        self._wb.add_named_style(style)
+        # Named styles are bound to their workbook, so only the fonts can be shared.
+        for name, font in STYLE_FONTS.items():
+            style = openpyxl.styles.NamedStyle(name=name)
+            style.font = font
+            self._wb.add_named_style(style)
 
     def row_writer(self, sheet: ResultSheet):
         ''' Create a row writer for the next row in given sheet. '''
@@ -266,18 +298,20 @@ class ResultSheetWriter:
         self.cell_writer(ResultSheet.OVERVIEW, 2, 4).write_date(bill_range.end)
 
         # Invoice type sums
+        details_end = self._current_row[ResultSheet.DETAILS]
+        # Invoice types are kept unique in order of appearance, so the formulas do not depend on
+        # set ordering.
         categories = {}
         for bci in bcis:
-            categories.setdefault(bci.category, set()).add(bci.invoice_type)
+            categories.setdefault(bci.category, {})[bci.invoice_type] = None
         for category, invoice_types in categories.items():
             row = self.row_writer(ResultSheet.OVERVIEW)
             row.write('')
             row.write(category)
-            row.write_currency(f'=D{row.row()}/((_xlfn.days($D$2,$C$2)+2)/IF(OR(MOD($C$2,400)=0,AND(MOD($C$2,4)=0,MOD($C$2,100)<>0)),365,366)*12)')
-            formulas = []
-            for invoice_type in invoice_types:
-                formulas.append(f'SUMIF({ResultSheet.DETAILS.value}!$D$2:$D${self._current_row[ResultSheet.DETAILS]},"{invoice_type}",{ResultSheet.DETAILS.value}!$N$2:$N${self._current_row[ResultSheet.DETAILS]})')
-            row.write_currency('=' + '+'.join(formulas))
+            row.write_currency(FORMULA_MONTHLY.format(row=row.row()))
+            row.write_currency('=' + '+'.join(
+                FORMULA_SUMIF.format(end=details_end, invoice_type=invoice_type)
+                for invoice_type in invoice_types))
             data_end_row = row.row()
 
         row = self.row_writer(ResultSheet.OVERVIEW)  # empty row
@@ -286,8 +320,8 @@ class ResultSheetWriter:
         row = self.row_writer(ResultSheet.OVERVIEW)
         row.write('')
         row.write('Summe', style='bold')
-        row.write_currency(f'=SUM($C$5:$C${row.row()-2}', style='bold')
-        row.write_currency(f'=SUM($D$5:$D${row.row()-2}', style='bold')
+        row.write_currency(FORMULA_SUM.format(column='C', end=row.row() - 2), style='bold')
+        row.write_currency(FORMULA_SUM.format(column='D', end=row.row() - 2), style='bold')
         row_sums = row.row()
 
         # Payments on advance
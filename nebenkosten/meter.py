@@ -4,7 +4,7 @@
 ''' Managing meter values '''
 
 import bisect
-from typing import Tuple
+from typing import Dict, Tuple
 
 from nebenkosten import Date, MeterValueException
 
@@ -12,30 +12,44 @@ from nebenkosten import Date, MeterValueException
 class MeterManager:
     ''' MeterValue helper
 
-    This class filter out all meter values of name given in the constructor.
+    This class manages the meter values of the meter given in the constructor.
 
     The most important part of this class is to replace dates with cell values in the formuale.
     Unfortunately, we cannot know the cell values before we write them into the result sheet.
     '''
 
     def __init__(self, meter_values, meter_name):
-        # Filter out meter values with different meter name.
+        # `meter_values` must only contain values of the meter `meter_name`
+        # (see InputSheetReader.meter_values_by_name).
         # Turn meter values into dictionary. The meter value date is its key.
-        self.values = { mv.date: mv for mv in meter_values if mv.name == meter_name }
+        self.values = { mv.date: mv for mv in meter_values }
 
         # For looking up surrounding dates, we need a list of all measured dates.
         self._measured_dates = sorted(list(self.values.keys()))
+        # Bisect on plain ints, which compare without calling Date.__lt__.
+        self._measured_ordinals = [d.to_ordinal() for d in self._measured_dates]
 
         self._meter_name = meter_name
 
+        # The same dates are looked up repeatedly, e.g. for range ends shared by invoices and
+        # again when creating the formula of a calculated meter value.
+        self._surrounding_dates: Dict[Date, Tuple[Date, Date]] = {}
+
     def get_surrounding_dates(self, date: Date) -> Tuple[Date, Date]:
         ''' Return the latest date before `date` and the first date after `date` '''
 
-        idx = bisect.bisect_left(self._measured_dates, date)
+        surrounding_dates = self._surrounding_dates.get(date)
+        if surrounding_dates:
+            return surrounding_dates
+
+        idx = bisect.bisect_left(self._measured_ordinals, date.to_ordinal())
         if 0 == idx:
             raise MeterValueException(
                 f'Kein Zählerstand für "{self._meter_name}" vor dem {date} gefunden.')
         if idx >= len(self._measured_dates):
             raise MeterValueException(
                 f'Kein Zählerstand für "{self._meter_name}" nach dem {date} gefunden.')
-        return self._measured_dates[idx - 1], self._measured_dates[idx]
+
+        surrounding_dates = self._measured_dates[idx - 1], self._measured_dates[idx]
+        self._surrounding_dates[date] = surrounding_dates
+        return surrounding_dates
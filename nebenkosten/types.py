@@ -4,10 +4,10 @@
 ''' Basic types used in nebenkosten '''
 
 from typing import List, Tuple
-import copy
 import enum
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 import datetime
+import functools
 import logging
 
 class MeterValueException(Exception):
@@ -19,9 +19,20 @@ class InvalidCellValue(Exception):
 class InputFileError(Exception):
     ''' Raised when there is a general error with the input file. '''
 
+@functools.lru_cache(maxsize=1024)
+def _parse_date(date_str: str) -> datetime.date:
+    ''' Parse a date string (DD.MM.YYYY). Invoices share most of their dates, so cache them. '''
+    return datetime.datetime.strptime(date_str, '%d.%m.%Y').date()
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(date: datetime.date) -> str:
+    ''' Format a date as string (DD.MM.YYYY), the inverse of _parse_date. '''
+    return f'{date.day:02d}.{date.month:02d}.{date.year:04d}'
+
 @dataclass
 class Date:
     ''' A date (Converts from string representation(s)) '''
+    __slots__ = ('date',)
     date: datetime.date
 
     def __init__(self, date: datetime.date):
@@ -30,7 +41,16 @@ class Date:
     @classmethod
     def from_str(cls, date_str: str):
         ''' Create Date from string '''
-        return Date(datetime.datetime.strptime(date_str, '%d.%m.%Y').date())
+        return Date(_parse_date(date_str))
+
+    @classmethod
+    def from_ordinal(cls, ordinal: int):
+        ''' Create Date from proleptic Gregorian ordinal '''
+        return Date(datetime.date.fromordinal(ordinal))
+
+    def to_ordinal(self) -> int:
+        ''' Get proleptic Gregorian ordinal (days since 01.01.0001) '''
+        return self.date.toordinal()
 
     def yesterday(self):
         ''' Get day before '''
@@ -50,7 +70,7 @@ class Date:
         return self.date > other.date
 
     def __str__(self):
-        return self.date.strftime('%d.%m.%Y')
+        return _format_date(self.date)
 
     def __hash__(self):
         return hash(self.date)
@@ -58,16 +78,14 @@ class Date:
 @dataclass
 class DateRange:
     ''' A date range '''
+    __slots__ = ('begin', 'end')
     begin: Date
     end: Date
 
     def overlaps(self, other) -> bool:
         ''' Check if this date overlaps with given date '''
-        if self.begin in other or self.end in other:
-            return True
-        if self.begin < other.begin and self.end > other.end:
-            return True
-        return False
+        # Two ranges overlap, if each one begins before the other one ends.
+        return self.begin.date <= other.end.date and other.begin.date <= self.end.date
 
     def __contains__(self, other) -> bool:
         ''' Check if date or daterange is in range '''
@@ -129,6 +147,8 @@ class DateCoverage:
 # pylint: disable=too-many-instance-attributes
 class Invoice:
     ''' Invoice structure '''
+    __slots__ = ('type', 'supplier', 'invoice_number', 'date', 'notes', 'range', 'net', 'amount',
+                 'tax', 'path')
     type: str
     supplier: str
     invoice_number: str
@@ -158,9 +178,9 @@ class Invoice:
                 continue
 
             if split_date >= self.range.begin:
-                invoice_split = copy.deepcopy(self)
-                invoice_split.range.begin = max(self.range.begin, invoice_begin)
-                invoice_split.range.end = min(self.range.end, split_date.yesterday())
+                invoice_split = replace(self, range=DateRange(
+                    max(self.range.begin, invoice_begin),
+                    min(self.range.end, split_date.yesterday())))
                 ret.append((invoice_split, people_count_before))
 
                 invoice_begin = split_date
@@ -172,8 +192,7 @@ class Invoice:
                 break
 
         if not end_of_invoice:
-            invoice_split = copy.deepcopy(self)
-            invoice_split.range.begin = invoice_begin
+            invoice_split = replace(self, range=DateRange(invoice_begin, self.range.end))
             ret.append((invoice_split, people_count_before))
 
         return ret
@@ -181,12 +200,14 @@ class Invoice:
 @dataclass
 class Appartement:
     ''' Appartement structure '''
+    __slots__ = ('name', 'size')
     name: str
     size: str
 
 @dataclass
 class Tenant:
     ''' Tenant structure '''
+    __slots__ = ('name', 'appartement', 'moving_in', 'moving_out', 'people', 'rent', 'advance')
     name: str
     appartement: str
     moving_in: Date
@@ -206,6 +227,7 @@ class Tenant:
 @dataclass
 class MeterValue:
     ''' MeterValue structure '''
+    __slots__ = ('name', 'count', 'date', 'notes')
     name: str
     count: str
     date: Date
@@ -214,6 +236,7 @@ class MeterValue:
 @dataclass
 class Meter:
     ''' MeterValue structure '''
+    __slots__ = ('name', 'number', 'unit')
     name: str
     number: str
     unit: str
@@ -232,8 +255,9 @@ class SplitType(enum.Enum):
 @dataclass
 class BillCalculationItem:
     ''' BillCalculationItem structure '''
+    __slots__ = ('appartement', 'split', 'unit', 'invoice_type', 'meter', 'category')
     appartement: str
-    split: str
+    split: SplitType
     unit: str
     invoice_type: str
     meter: str
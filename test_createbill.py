@@ -2,11 +2,18 @@
 
 import unittest
 import datetime
+import os
+import re
+import tempfile
+import zipfile
+import openpyxl
 import pytest
 
 from nebenkosten import Tenant, Date, DateRange, DateCoverage
-from nebenkosten import Invoice
+from nebenkosten import Invoice, MeterValue, MeterManager, MeterValueException
 from nebenkosten import get_people_count_changes
+from nebenkosten import InputSheetReader
+from createbill import BillCreator
 
 class CreateBill(unittest.TestCase):
     def testDateRangeContains(self):
@@ -34,8 +41,17 @@ class CreateBill(unittest.TestCase):
         assert Date.from_str('02.01.2020').tomorrow() == Date.from_str('03.01.2020')
         assert Date.from_str('31.12.2020').tomorrow() == Date.from_str('01.01.2021')
 
+    def testOrdinal(self):
+        assert Date.from_str('01.01.2020').to_ordinal() + 1 == Date.from_str('02.01.2020').to_ordinal()
+        assert Date.from_ordinal(Date.from_str('31.12.2020').to_ordinal() + 1) == Date.from_str('01.01.2021')
+
+    def testDateStr(self):
+        assert str(Date.from_str('01.02.2020')) == '01.02.2020'
+        assert str(Date.from_str('1.2.2020')) == '01.02.2020'
+        assert str(Date(datetime.date(2020, 12, 31))) == '31.12.2020'
+
     def testTenantDefault(self):
-        tenant = Tenant('Tenant Name', 'Appartement Name', Date.from_str('15.01.2019'), Date.from_str('12.05.2021'), 1)
+        tenant = Tenant('Tenant Name', 'Appartement Name', Date.from_str('15.01.2019'), Date.from_str('12.05.2021'), 1, None, None)
         assert tenant.name == 'Tenant Name'
         assert tenant.appartement == 'Appartement Name'
         assert tenant.moving_in == Date.from_str('15.01.2019')
@@ -48,7 +64,7 @@ class CreateBill(unittest.TestCase):
         assert Date.from_str('13.05.2021') not in tenant
 
     def testTenantNotMoveOut(self):
-        tenant = Tenant('Tenant Name', 'Appartement Name', Date.from_str('15.01.2019'), None, 1)
+        tenant = Tenant('Tenant Name', 'Appartement Name', Date.from_str('15.01.2019'), None, 1, None, None)
         assert tenant.moving_out == None
 
         assert Date.from_str('14.01.2019') not in tenant
@@ -70,6 +86,19 @@ class CreateBill(unittest.TestCase):
         assert range_b.overlaps(range_a)
         assert range_a.overlaps(range_b)
 
+        # Contained ranges overlap
+        range_c = DateRange(Date.from_str('05.01.2020'), Date.from_str('10.01.2020'))
+        assert range_a.overlaps(range_c)
+        assert range_c.overlaps(range_a)
+
+        # Ranges touching on a single day overlap, adjacent ranges do not
+        range_d = DateRange(Date.from_str('15.01.2020'), Date.from_str('31.01.2020'))
+        range_e = DateRange(Date.from_str('16.01.2020'), Date.from_str('31.01.2020'))
+        assert range_a.overlaps(range_d)
+        assert range_d.overlaps(range_a)
+        assert not range_a.overlaps(range_e)
+        assert not range_e.overlaps(range_a)
+
     def testDateInRange(self):
         range = DateRange(
             Date.from_str('01.01.2020'),
@@ -132,10 +161,10 @@ class CreateBill(unittest.TestCase):
 
     def test_get_people_count_change_dates(self):
         tenants = [
-            Tenant('T1', 'A1', Date.from_str('01.01.2020'), Date.from_str('31.01.2020'), 1),
-            Tenant('T2', 'A1', Date.from_str('01.02.2020'), Date.from_str('31.12.2020'), 2),
-            Tenant('T3', 'A2', Date.from_str('01.01.2020'), Date.from_str('31.08.2020'), 3),
-            Tenant('T3', 'A2', Date.from_str('01.09.2020'), Date.from_str('31.12.2020'), 1),
+            Tenant('T1', 'A1', Date.from_str('01.01.2020'), Date.from_str('31.01.2020'), 1, None, None),
+            Tenant('T2', 'A1', Date.from_str('01.02.2020'), Date.from_str('31.12.2020'), 2, None, None),
+            Tenant('T3', 'A2', Date.from_str('01.01.2020'), Date.from_str('31.08.2020'), 3, None, None),
+            Tenant('T3', 'A2', Date.from_str('01.09.2020'), Date.from_str('31.12.2020'), 1, None, None),
         ]
         split_dates = get_people_count_changes(DateRange(Date.from_str('01.01.2020'), Date.from_str('31.12.2020')), tenants)
 
@@ -150,8 +179,130 @@ class CreateBill(unittest.TestCase):
         assert split_dates[2][0] == Date.from_str('01.09.2020')
         assert split_dates[2][1] == 3
 
+    def test_get_people_count_change_dates_outside_range(self):
+        tenants = [
+            Tenant('T1', 'A1', Date.from_str('01.01.2019'), None, 2, None, None),
+            Tenant('T2', 'A2', Date.from_str('01.01.2019'), Date.from_str('31.12.2019'), 1, None, None),
+            Tenant('T3', 'A2', Date.from_str('01.03.2020'), Date.from_str('31.12.2020'), 1, None, None),
+            Tenant('T4', 'A3', Date.from_str('01.06.2020'), Date.from_str('30.06.2021'), 3, None, None),
+            Tenant('T5', 'A3', Date.from_str('01.01.2021'), None, 4, None, None),
+        ]
+        split_dates = get_people_count_changes(DateRange(Date.from_str('01.01.2020'), Date.from_str('31.12.2020')), tenants)
+
+        assert split_dates == [
+            (Date.from_str('01.01.2020'), 2),
+            (Date.from_str('01.03.2020'), 3),
+            (Date.from_str('01.06.2020'), 6),
+        ]
+
+    def test_meter_manager_surrounding_dates(self):
+        meter_values = [
+            MeterValue('Name', 15.6, Date.from_str('01.01.2020'), ''),
+            MeterValue('Name', 55.6, Date.from_str('01.02.2020'), ''),
+            MeterValue('Name', 100, Date.from_str('01.03.2020'), ''),
+        ]
+        meter_manager = MeterManager(meter_values, 'Name')
+
+        assert len(meter_manager.values) == 3
+        assert meter_manager.get_surrounding_dates(Date.from_str('15.01.2020')) == \
+            (Date.from_str('01.01.2020'), Date.from_str('01.02.2020'))
+        assert meter_manager.get_surrounding_dates(Date.from_str('15.02.2020')) == \
+            (Date.from_str('01.02.2020'), Date.from_str('01.03.2020'))
+        # Repeated lookups return the same result
+        assert meter_manager.get_surrounding_dates(Date.from_str('15.02.2020')) == \
+            (Date.from_str('01.02.2020'), Date.from_str('01.03.2020'))
+
+        with pytest.raises(MeterValueException):
+            meter_manager.get_surrounding_dates(Date.from_str('31.12.2019'))
+        with pytest.raises(MeterValueException):
+            meter_manager.get_surrounding_dates(Date.from_str('02.03.2020'))
+
+    def test_input_sheet_with_stale_dimension(self):
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        def add_sheet(name, header, rows):
+            sheet = workbook.create_sheet(name)
+            sheet.append(header)
+            for row in rows:
+                sheet.append(row)
+        add_sheet('Rechnungen', list('ABCDEFGHIJKL'), [
+            ['Strom', 'S', '1', '01.02.2021', None, '01.01.2020', '31.12.2020', 0.3, 1000, 0.19],
+            ['Müll', 'S', '2', '01.02.2021', None, '01.01.2020', '31.12.2020', 300, 1, 0.19],
+            ['Wasser', 'S', '3', '01.02.2021', None, '01.01.2020', '31.12.2020', 3, 100, 0.07],
+        ])
+        add_sheet('Wohnungen', list('AB'), [['W1', 80], ['W2', 60]])
+        add_sheet('Mieter', list('ABCDEFG'), [
+            ['T1', 'W1', '01.01.2019', None, 2],
+            ['T2', 'W2', '01.01.2019', None, 1],
+        ])
+        add_sheet('Zählerstände', list('ABCD'), [['Z1', 100, '01.01.2020'], ['Z1', 600, '01.01.2021']])
+        add_sheet('Zähler', list('ABC'), [['Z1', '111', 'kWh']])
+        add_sheet('Abrechnungseinstellungen', list('ABCDEF'), [
+            ['W1', 'Nach Verbrauch', 'kWh', 'Strom', 'Z1', 'Energie'],
+            ['W1', 'Pro Person', None, 'Müll', None, 'Entsorgung'],
+        ])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'input.xlsx')
+            workbook.save(path)
+
+            # Other tools may store a wrong sheet dimension, which must not cut off any rows.
+            stale_path = os.path.join(tmp_dir, 'stale.xlsx')
+            with zipfile.ZipFile(path) as source, zipfile.ZipFile(stale_path, 'w') as target:
+                for item in source.infolist():
+                    data = source.read(item)
+                    if item.filename.startswith('xl/worksheets/'):
+                        data = re.sub(b'<dimension ref="[^"]*"', b'<dimension ref="A1"', data)
+                    target.writestr(item, data)
+
+            bill_range = DateRange(Date.from_str('01.01.2020'), Date.from_str('31.12.2020'))
+            input_sheet = InputSheetReader(stale_path, 'W1', bill_range)
+
+        assert len(input_sheet.invoices) == 3
+        assert input_sheet.invoices[2].path is None
+        assert len(input_sheet.appartements) == 2
+        assert input_sheet.tenant.name == 'T1'
+        assert input_sheet.tenant.rent is None
+        assert len(input_sheet.meter_values) == 2
+        assert len(input_sheet.bcis) == 2
+
+    def test_missing_receipt_leaves_no_archive(self):
+        workbook = openpyxl.Workbook()
+        workbook.remove(workbook.active)
+        for name, header, rows in [
+                ('Rechnungen', list('ABCDEFGHIJKL'), [
+                    ['Müll', 'S', '1', '01.02.2021', None, '01.01.2020', '31.12.2020', 300, 1, 0.19,
+                        None, 'vorhanden.pdf'],
+                    ['Müll', 'S', '2', '01.02.2021', None, '01.01.2020', '31.12.2020', 300, 1, 0.19,
+                        None, 'fehlt.pdf'],
+                ]),
+                ('Wohnungen', list('AB'), [['W1', 80]]),
+                ('Mieter', list('ABCDEFG'), [['T1', 'W1', '01.01.2019', None, 2, 500, 100]]),
+                ('Zählerstände', list('ABCD'), []),
+                ('Zähler', list('ABC'), []),
+                ('Abrechnungseinstellungen', list('ABCDEF'), [
+                    ['W1', 'Pro Wohnung', None, 'Müll', None, 'Entsorgung'],
+                ])]:
+            sheet = workbook.create_sheet(name)
+            sheet.append(header)
+            for row in rows:
+                sheet.append(row)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'input.xlsx')
+            workbook.save(path)
+            with open(os.path.join(tmp_dir, 'vorhanden.pdf'), 'wb') as receipt:
+                receipt.write(b'%PDF')
+
+            bill_range = DateRange(Date.from_str('01.01.2020'), Date.from_str('31.12.2020'))
+            input_sheet = InputSheetReader(path, 'W1', bill_range)
+            bill = BillCreator(input_sheet, bill_range, os.path.join(tmp_dir, 'bill.xlsx'))
+            with pytest.raises(FileNotFoundError):
+                bill.create(tmp_dir)
+            assert not os.path.exists(os.path.join(tmp_dir, 'bill.zip'))
+
     def test_split_dates(self):
-        invoice = Invoice('I', 'S', 'N', Date(datetime.date(2020, 1, 24)), None, DateRange(Date(datetime.date(2020, 1, 1)), Date(datetime.date(2020, 12, 31))), 138, 1, 0)
+        invoice = Invoice('I', 'S', 'N', Date(datetime.date(2020, 1, 24)), None, DateRange(Date(datetime.date(2020, 1, 1)), Date(datetime.date(2020, 12, 31))), 138, 1, 0, None)
 
         # Empty split dates
         invoices = invoice.split([])
@@ -172,6 +323,11 @@ class CreateBill(unittest.TestCase):
         assert invoices[1][1] == 7
         assert invoices[2][1] == 6
 
+        # Split invoices get their own ranges, the original invoice is not changed
+        assert invoices[0][0].range == DateRange(Date(datetime.date(2020, 1, 1)), Date(datetime.date(2020, 8, 31)))
+        assert invoices[2][0].range == DateRange(Date(datetime.date(2020, 9, 1)), Date(datetime.date(2020, 12, 31)))
+        assert invoice.range == DateRange(Date(datetime.date(2020, 1, 1)), Date(datetime.date(2020, 12, 31)))
+
     # def test_split_invoice_where_person_count_changes(self):
     #     tenants = [
     #         Tenant.from_row(['T1', 'A1', '01.01.2020', '31.01.2020', 1]),